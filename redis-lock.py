@@ -1,36 +1,220 @@
+import asyncio
+import hashlib
+import os
+import random
 import threading
 import time as mod_time
-import uuid
-from types import SimpleNamespace
-from redis.exceptions import LockError, LockNotOwnedError
+import weakref
+from redis.exceptions import LockError, LockNotOwnedError, NoScriptError, RedisError
+
+
+# 已经执行过 SCRIPT LOAD 的连接池 (RedisCluster 为客户端本身)。用弱引用保存连接池对象本身而不是 id，
+# 连接池被回收后自动移除，也不会因为 id 被复用而误认为新的连接池已经加载过脚本
+_LOADED_POOLS = weakref.WeakSet()
+
+
+def _pool_key(redis):
+    """
+    按连接池区分 Redis 服务端。RedisCluster 没有 connection_pool 属性，它自己管理所有节点的连接，直接用客户端对象本身
+    """
+    return getattr(redis, "connection_pool", redis)
+
+
+def _sha1(script):
+    return hashlib.sha1(script.encode()).hexdigest()
+
+
+class _ReleaseListener:
+    """
+    一个连接池对应一个监听器，用一条 PSUBSCRIBE lock-release:* 连接接收锁释放的消息，
+    再由后台线程唤醒本进程内所有等待这个锁的 acquire，不用每个等待者各自占用一条订阅连接
+    """
+
+    # 没有等待者超过这个秒数后，后台线程退出并关闭订阅连接
+    IDLE_TIMEOUT = 30.0
+
+    def __init__(self, redis):
+        self.pool = _pool_key(redis)
+        self.encoder = redis.get_encoder()
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            self.pubsub.psubscribe(Lock.RELEASE_CHANNEL_PREFIX + b"*")
+        except RedisError:
+            self.pubsub.close()
+            raise
+        # 频道名 -> 等待这个锁的 Event 集合，每个等待者一个 Event
+        self.waiters = {}
+        self.mutex = threading.Lock()
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, name="redis-lock-release-listener", daemon=True)
+        self.thread.start()
+
+    def register(self, channel):
+        """
+        登记一个等待者，返回收到释放消息时会被 set 的 Event。监听器已经退出时返回 None
+        """
+        event = threading.Event()
+        with self.mutex:
+            if not self.alive:
+                return None
+            self.waiters.setdefault(channel, set()).add(event)
+        return event
+
+    def unregister(self, channel, event):
+        with self.mutex:
+            events = self.waiters.get(channel)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self.waiters[channel]
+
+    def stop(self):
+        """
+        让后台线程在下一次检查时退出
+        """
+        with self.mutex:
+            self.alive = False
+
+    def run(self):
+        idle_since = mod_time.monotonic()
+        try:
+            while True:
+                message = self.pubsub.get_message(timeout=1.0)
+                with self.mutex:
+                    if not self.alive:
+                        return
+                    if message is not None:
+                        # decode_responses=True 的客户端收到的频道名是 str，统一编码成 bytes
+                        events = self.waiters.get(self.encoder.encode(message["channel"]), ())
+                        for event in events:
+                            event.set()
+                    if self.waiters:
+                        idle_since = mod_time.monotonic()
+                    elif mod_time.monotonic() - idle_since > self.IDLE_TIMEOUT:
+                        self.alive = False
+                        return
+        except RedisError:
+            pass
+        finally:
+            with self.mutex:
+                self.alive = False
+                # 唤醒剩下的等待者，让它们发现监听器已经退出并退回到轮询
+                for events in self.waiters.values():
+                    for event in events:
+                        event.set()
+            with _RELEASE_LISTENERS_LOCK:
+                if _RELEASE_LISTENERS.get(self.pool) is self:
+                    del _RELEASE_LISTENERS[self.pool]
+            self.pubsub.close()
+
+
+# 连接池 -> 正在运行的 _ReleaseListener
+_RELEASE_LISTENERS = {}
+_RELEASE_LISTENERS_LOCK = threading.Lock()
+
+
+def _get_release_listener(redis):
+    pool = _pool_key(redis)
+    with _RELEASE_LISTENERS_LOCK:
+        seen = _RELEASE_LISTENERS.get(pool)
+    if seen is not None and seen.alive:
+        return seen
+    # 创建监听器需要一次网络往返 (PSUBSCRIBE)，放在全局锁外面，Redis 变慢时不会卡住其他连接池的等待者
+    listener = _ReleaseListener(redis)
+    with _RELEASE_LISTENERS_LOCK:
+        current = _RELEASE_LISTENERS.get(pool)
+        # 只有注册表里还是之前看到的那个 (或者已经退出) 才替换成新的监听器
+        if current is seen or current is None or not current.alive:
+            _RELEASE_LISTENERS[pool] = listener
+            return listener
+    # 其他线程已经先创建好了，关闭多创建的这个
+    listener.stop()
+    return current
+
+
+class _TokenHolder:
+    """
+    thread_local 为 False 时保存 token 的对象，只有一个 slot，比 SimpleNamespace 更轻，读取 token 也更快
+    """
+
+    __slots__ = ("token",)
+
+
+def _retry_delay(lock, attempt, stop_trying_at):
+    """
+    计算获取锁失败后下一次重试之前的等待秒数，Lock 和 AsyncLock 共用。
+    返回 (delay, attempt)，attempt 是下一次调用时传入的重试次数；已经没有时间再重试时 delay 为 None
+    """
+    if lock.backoff:
+        # full jitter 指数退避：在 [0, min(cap, base * 2 ** attempt)] 之间随机休眠，
+        # 避免大量客户端在同一时刻一起重试 (惊群)
+        ceiling = lock.sleep_base * (2 ** attempt)
+        if ceiling < lock.sleep_cap:
+            attempt += 1
+        else:
+            ceiling = lock.sleep_cap
+        delay = random.uniform(0, ceiling)
+        if stop_trying_at is not None:
+            remaining = stop_trying_at - mod_time.monotonic()
+            # 已经超过了设置的获取锁的时间
+            if remaining <= 0:
+                return None, attempt
+            # 休眠不超过剩余的等待时间，醒来后还能再尝试最后一次
+            delay = min(delay, remaining)
+        return delay, attempt
+    # 下一次重试获取锁的时间
+    next_try_at = mod_time.monotonic() + lock.sleep
+    # 如果超过了设置的获取锁的时间还没有获取到锁，就不再重试
+    if stop_trying_at is not None and next_try_at > stop_trying_at:
+        return None, attempt
+    return lock.sleep, attempt
 
 
 class Lock:
-    lua_release = None
-    lua_extend = None
-    lua_reacquire = None
+    # 固定实例属性，属性访问走 slot 描述符而不是实例 __dict__
+    __slots__ = (
+        "redis",
+        "name",
+        "_timeout",
+        "timeout_ms",
+        "sleep",
+        "blocking",
+        "blocking_timeout",
+        "backoff",
+        "sleep_base",
+        "sleep_cap",
+        "thread_local",
+        "local",
+        "_encoder",
+        "__weakref__",
+    )
+
+    # 锁释放时发布通知的频道前缀，完整的频道名为 前缀 + 锁名称
+    RELEASE_CHANNEL_PREFIX = b"lock-release:"
 
     # KEYS[1] - 锁名称
     # ARGV[1] - 锁 token
     # 如果释放了锁，返回1，否则返回0
+    # 释放成功后在 lock-release:<锁名称> 频道发布一条消息，唤醒正在等待这个锁的客户端
+    # 脚本里的 'lock-release:' 必须和 RELEASE_CHANNEL_PREFIX 保持一致，否则等待者收不到通知，只能退回到轮询
     LUA_RELEASE_SCRIPT = """
         local token = redis.call('get', KEYS[1])
         if not token or token ~= ARGV[1] then
             return 0
         end
         redis.call('del', KEYS[1])
+        redis.call('publish', 'lock-release:' .. KEYS[1], '1')
         return 1
     """
 
     # KEYS[1] - 锁名称
     # ARGV[1] - 锁 token
-    # ARGV[2] - 锁续期 milliseconds 值
-    # ARGV[3] - 如果将额外的时间加到锁现有的TTL上，则为0; 如果替换现有的TTL，则为1
+    # ARGV[2] - 锁续期 milliseconds 值，加到锁现有的TTL上
     # 如果锁时间延长则返回1，否则返回0
 
     # Redis pttl 命令以毫秒为单位返回 key 的剩余过期时间。
     # Redis pexpire 以毫秒为单位设置 key 的生存时间
-    LUA_EXTEND_SCRIPT = """
+    LUA_EXTEND_ADD_SCRIPT = """
         local token = redis.call('get', KEYS[1])
         if not token or token ~= ARGV[1] then
             return 0
@@ -42,11 +226,23 @@ class Lock:
         if expiration < 0 then
             return 0
         end
-        local newttl = ARGV[2]
-        if ARGV[3] == "0" then
-            newttl = ARGV[2] + expiration
+        redis.call('pexpire', KEYS[1], ARGV[2] + expiration)
+        return 1
+    """
+
+    # KEYS[1] - 锁名称
+    # ARGV[1] - 锁 token
+    # ARGV[2] - 锁续期 milliseconds 值，替换锁现有的TTL
+    # 如果锁时间延长则返回1，否则返回0
+    LUA_EXTEND_REPLACE_SCRIPT = """
+        local token = redis.call('get', KEYS[1])
+        if not token or token ~= ARGV[1] then
+            return 0
+        end
+        if redis.call('pttl', KEYS[1]) < 0 then
+            return 0
         end
-        redis.call('pexpire', KEYS[1], newttl)
+        redis.call('pexpire', KEYS[1], ARGV[2])
         return 1
     """
 
@@ -63,46 +259,164 @@ class Lock:
         return 1
     """
 
-    def __init__(self, redis, name, timeout=None, sleep=0.1, blocking=True, blocking_timeout=None, thread_local=True):
+    # KEYS[1] - 锁名称
+    # ARGV[1] - 锁 token
+    # 如果锁被该 token 持有，返回1，否则返回0
+    LUA_OWNED_SCRIPT = """
+        local token = redis.call('get', KEYS[1])
+        if token and token == ARGV[1] then
+            return 1
+        end
+        return 0
+    """
+
+    # KEYS[1] - 锁名称
+    # ARGV[1] - 锁 token
+    # ARGV[2] - 锁释放时间 milliseconds 值，没有设置 timeout 时不传
+    # 如果上锁成功，返回锁的 PTTL (没有过期时间时为 -1)，否则返回 nil
+    LUA_ACQUIRE_SCRIPT = """
+        local acquired
+        if ARGV[2] then
+            acquired = redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2])
+        else
+            acquired = redis.call('set', KEYS[1], ARGV[1], 'NX')
+        end
+        if not acquired then
+            return false
+        end
+        return redis.call('pttl', KEYS[1])
+    """
+
+    # 脚本的 SHA1 在类加载时计算一次，之后通过 EVALSHA 调用，不用每次都发送脚本内容
+    LUA_RELEASE_SHA = _sha1(LUA_RELEASE_SCRIPT)
+    LUA_EXTEND_ADD_SHA = _sha1(LUA_EXTEND_ADD_SCRIPT)
+    LUA_EXTEND_REPLACE_SHA = _sha1(LUA_EXTEND_REPLACE_SCRIPT)
+    LUA_REACQUIRE_SHA = _sha1(LUA_REACQUIRE_SCRIPT)
+    LUA_OWNED_SHA = _sha1(LUA_OWNED_SCRIPT)
+    LUA_ACQUIRE_SHA = _sha1(LUA_ACQUIRE_SCRIPT)
+
+    # (SHA1, 脚本) 列表，用于批量检查和加载
+    LUA_SCRIPTS = (
+        (LUA_RELEASE_SHA, LUA_RELEASE_SCRIPT),
+        (LUA_EXTEND_ADD_SHA, LUA_EXTEND_ADD_SCRIPT),
+        (LUA_EXTEND_REPLACE_SHA, LUA_EXTEND_REPLACE_SCRIPT),
+        (LUA_REACQUIRE_SHA, LUA_REACQUIRE_SCRIPT),
+        (LUA_OWNED_SHA, LUA_OWNED_SCRIPT),
+        (LUA_ACQUIRE_SHA, LUA_ACQUIRE_SCRIPT),
+    )
+
+    # 锁已经不再被持有时的错误信息。这里只缓存字符串，每次抛出的仍是新的异常实例，
+    # 共享同一个异常实例会在多线程之间互相覆盖 __traceback__，并让旧的栈帧一直无法释放
+    NOT_OWNED_RELEASE = "Cannot release a lock that's no longer owned"
+    NOT_OWNED_EXTEND = "Cannot extend a lock that's no longer owned"
+    NOT_OWNED_REACQUIRE = "Cannot reacquire a lock that's no longer owned"
+
+    def __init__(
+        self,
+        redis,
+        name,
+        timeout=None,
+        sleep=0.1,
+        blocking=True,
+        blocking_timeout=None,
+        thread_local=True,
+        backoff=False,
+        sleep_base=0.001,
+        sleep_cap=1.0,
+    ):
         """
         使用Redis提供的Redis客户端创建一个名为 'name' 的新锁实例。
 
         timeout - 锁释放时间，可以指定为浮点数或整数，单位是秒
-        sleep - 另一个客户端当前持有锁时，每个循环迭代的休眠时间。
+        sleep - 另一个客户端当前持有锁时，每个循环迭代的休眠时间。仅在 backoff 为 False 时使用
         blocking - 另一个客户端当前持有锁时，在调用 'acquire' 上锁时，会阻塞直到之前锁被释放后获取还是立即返回上锁失败
         blocking_timeout - 是 blocking 的超时时间，None 表示永不过期，直到抢到锁为止，也可以指定为浮点数或整数，单位是秒
-        thread_local - 锁的 token 是否放置在线程本地存储中。默认情况下，令牌被放置在线程本地存储中
+        thread_local - 锁的 token 是否放置在线程本地存储中。默认情况下，令牌被放置在线程本地存储中。
+            为 False 时 token 保存在只有一个 slot 的 local 对象上
+        backoff - 获取锁失败后是否使用带随机抖动的指数退避 (full jitter) 来计算休眠时间。默认为 False，每次固定休眠 'sleep' 秒
+        sleep_base - 指数退避的基础休眠时间，单位是秒
+        sleep_cap - 指数退避的最大休眠时间，单位是秒
         """
         self.redis = redis
         self.name = name
+        # timeout 的 setter 会同时换算 timeout_ms
         self.timeout = timeout
         self.sleep = sleep
         self.blocking = blocking
         self.blocking_timeout = blocking_timeout
+        self.backoff = backoff
+        self.sleep_base = sleep_base
+        self.sleep_cap = sleep_cap
         self.thread_local = bool(thread_local)
-        self.local = (
-            threading.local()
-            if self.thread_local
-            else SimpleNamespace()  # 一个简单的 object 子类，可以添加和移除属性
-        )
+        # 不论是否 thread_local，读写 token 都是 self.local.token，热路径上不用再判断
+        self.local = threading.local() if self.thread_local else _TokenHolder()
         self.local.token = None
-        self.register_scripts()  # 实例化的时候就加载 LUA 脚本
+        # 编码器在实例化时取一次，之后编码 token 和锁名称时直接使用
+        self._encoder = redis.get_encoder()
+        # 每个连接池第一次实例化锁的时候加载 LUA 脚本
+        if _pool_key(redis) not in _LOADED_POOLS:
+            self.register_scripts()
+
+    @property
+    def timeout(self):
+        """
+        锁释放时间，单位是秒
+        """
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        # 锁释放时间的毫秒值只在设置 timeout 时换算一次，没有设置 timeout 时为 None
+        self._timeout = value
+        self.timeout_ms = int(value * 1000) if value else None
+
+    @property
+    def token(self):
+        """
+        当前持有的锁 token，没有持有锁时为 None
+        """
+        # 其他线程第一次访问时 threading.local 上还没有 token 属性
+        return getattr(self.local, "token", None)
+
+    @token.setter
+    def token(self, value):
+        self.local.token = value
 
     def register_scripts(self):
         """
-        加载三个 LUA 脚本
+        加载六个 LUA 脚本，每个连接池只执行一次
         1. 释放锁的 LUA 脚本
-        2. 锁续期的 LUA 脚本
-        3. 重新获取锁的 LUA 脚本
-        """
-        cls = self.__class__
-        client = self.redis
-        if cls.lua_release is None:
-            cls.lua_release = client.register_script(cls.LUA_RELEASE_SCRIPT)
-        if cls.lua_extend is None:
-            cls.lua_extend = client.register_script(cls.LUA_EXTEND_SCRIPT)
-        if cls.lua_reacquire is None:
-            cls.lua_reacquire = client.register_script(cls.LUA_REACQUIRE_SCRIPT)
+        2. 在现有 TTL 上增加时间的锁续期 LUA 脚本
+        3. 替换现有 TTL 的锁续期 LUA 脚本
+        4. 重新获取锁的 LUA 脚本
+        5. 判断锁是否被当前 token 持有的 LUA 脚本
+        6. 上锁并返回锁 PTTL 的 LUA 脚本
+        """
+        self.ensure_scripts_loaded(self.redis)
+        _LOADED_POOLS.add(_pool_key(self.redis))
+
+    @classmethod
+    def ensure_scripts_loaded(cls, client):
+        """
+        用一次 SCRIPT EXISTS 检查所有脚本是否已经缓存在 Redis 中，只对缺失的脚本执行 SCRIPT LOAD。
+        Redis 重启或主从切换后脚本缓存会被清空，可以在重连后调用，避免之后第一次调用每个脚本时都遇到 NOSCRIPT。
+        返回重新加载的脚本数量
+        """
+        exists = client.script_exists(*[sha for sha, _ in cls.LUA_SCRIPTS])
+        missing = [script for (_, script), loaded in zip(cls.LUA_SCRIPTS, exists) if not loaded]
+        for script in missing:
+            client.script_load(script)
+        return len(missing)
+
+    def run_script(self, sha, script, *args):
+        """
+        通过 EVALSHA 执行脚本，KEYS[1] 固定为锁名称。
+        如果 Redis 中没有缓存该脚本 (例如 Redis 重启后)，返回 NOSCRIPT 错误，此时退回到 EVAL，EVAL 同时会重新缓存脚本
+        """
+        try:
+            return self.redis.evalsha(sha, 1, self.name, *args)
+        except NoScriptError:
+            return self.redis.eval(script, 1, self.name, *args)
 
     # 提供 with 语法
     def __enter__(self):
@@ -117,14 +431,26 @@ class Lock:
         """
         blocking - 是否阻塞获取锁
         blocking_timeout - 获取锁所等待的最大秒数
-        token - token必须是一个 bytes 对象或可以用默认编码编码到 bytes 对象的字符串。如果没有指定令牌，将使用 UUID。
+        token - token必须是一个 bytes 对象或可以用默认编码编码到 bytes 对象的字符串。如果没有指定令牌，将使用 16 字节随机数的十六进制值。
+        """
+        return self._acquire(self.do_acquire, blocking, blocking_timeout, token) is not None
+
+    def acquire_with_ttl(self, blocking=None, blocking_timeout=None, token=None):
+        """
+        和 acquire 一样获取锁，获取成功时返回锁剩余的过期时间 (毫秒，没有设置 timeout 时为 -1)，获取失败时返回 None。
+        需要在上锁后马上知道锁的过期时间 (例如启动续期线程) 的调用方，不用再单独发一次 PTTL 命令
+        """
+        return self._acquire(self.do_acquire_with_ttl, blocking, blocking_timeout, token)
+
+    def _acquire(self, do_acquire, blocking, blocking_timeout, token):
+        """
+        获取锁的重试循环。do_acquire 获取失败时返回 False 或 None，获取成功时返回的值作为结果返回，获取失败返回 None
         """
-        sleep = self.sleep
         if token is None:
-            token = uuid.uuid1().hex.encode()
+            # os.urandom 只是一次系统调用，不像 uuid1 需要加锁、读取 MAC 地址和时钟
+            token = os.urandom(16).hex().encode("ascii")
         else:
-            encoder = self.redis.connection_pool.get_encoder()
-            token = encoder.encode(token)
+            token = self._encoder.encode(token)
 
         # acquire 的 blocking 和 blocking_timeout 参数优先级高于实例化时候的。acquire 的时候没设置就用实例化的时候的
         if blocking is None:
@@ -138,50 +464,95 @@ class Lock:
             # time.monotonic()（以小数表示的秒为单位）返回一个单调时钟的值，即不能倒退的时钟。 该时钟不受系统时钟更新的影响。
             stop_trying_at = mod_time.monotonic() + blocking_timeout
 
-        while True:
-            # 成功上锁
-            if self.do_acquire(token):
-                self.local.token = token
-                return True
-            # 如果锁获取失败，且没有设置 blocking 阻塞，那么立即返回 False
-            if not blocking:
-                return False
-            # 下一次重试获取锁的时间
-            next_try_at = mod_time.monotonic() + sleep
-            # 如果超过了设置的获取锁的时间还没有获取到锁，那么就直接返回 False
-            if stop_trying_at is not None and next_try_at > stop_trying_at:
-                return False
-            mod_time.sleep(sleep)
+        attempt = 0
+        channel = None
+        listener = None
+        event = None
+        try:
+            while True:
+                # 每次尝试之前清除唤醒标记，尝试之后才发生的释放会重新 set
+                if event is not None:
+                    event.clear()
+                # 成功上锁
+                result = do_acquire(token)
+                if result is not False and result is not None:
+                    self.local.token = token
+                    return result
+                # 如果锁获取失败，且没有设置 blocking 阻塞，那么立即返回
+                if not blocking:
+                    return None
+                delay, next_attempt = _retry_delay(self, attempt, stop_trying_at)
+                if delay is None:
+                    return None
+                # 确定要等待之后才登记等待锁释放的通知，不等待就返回的调用不会占用订阅连接。
+                # 登记成功后马上再试一次，避免错过登记之前就已经发生的释放
+                if channel is None:
+                    channel = self.RELEASE_CHANNEL_PREFIX + self._encoder.encode(self.name)
+                    listener, event = self.wait_for_release(channel)
+                    if event is not None:
+                        continue
+                attempt = next_attempt
+                if event is None:
+                    mod_time.sleep(delay)
+                    continue
+                # 最多等待 delay 秒，期间收到锁释放的消息就马上醒来重试。
+                # 锁因为过期被删除时不会发布消息，所以仍然需要超时后重试
+                event.wait(delay)
+                if not listener.alive:
+                    # 监听线程已经退出 (订阅连接出错)，退回到轮询
+                    listener.unregister(channel, event)
+                    listener = event = None
+        finally:
+            if event is not None:
+                listener.unregister(channel, event)
+
+    def wait_for_release(self, channel):
+        """
+        在本进程共享的监听器上登记等待这个锁的释放，返回 (监听器, Event)。
+        订阅失败时返回 (None, None)，调用方退回到轮询
+        """
+        try:
+            listener = _get_release_listener(self.redis)
+        except RedisError:
+            return None, None
+        event = listener.register(channel)
+        if event is None:
+            return None, None
+        return listener, event
 
     def do_acquire(self, token):
-        # 将锁的释放时间转换为毫秒
-        if self.timeout:
-            # convert to milliseconds
-            timeout = int(self.timeout * 1000)
-        else:
-            timeout = None
         # 上锁。self.name 为锁名称，token 为锁的值。
         # 在 Redis 中如果使用了 NX 选项，SET 命令只有在键值对不存在时，才会进行设置，否则不做赋值操作
         # 在 Redis 中使用 px 来设置 key 的过期时间，单位为毫秒。ex 也可以设置，不过单位为秒
-        if self.redis.set(self.name, token, nx=True, px=timeout):
+        if self.redis.set(self.name, token, nx=True, px=self.timeout_ms):
             return True
         return False
 
+    def do_acquire_with_ttl(self, token):
+        """
+        和 do_acquire 一样上锁，同时取回锁的 PTTL。SET 和 PTTL 在同一个 LUA 脚本里执行，只需要一次网络往返，
+        而且返回的一定是刚刚设置的锁的 PTTL。上锁成功返回 PTTL 的值，失败返回 None
+        """
+        if self.timeout_ms is None:
+            return self.run_script(self.LUA_ACQUIRE_SHA, self.LUA_ACQUIRE_SCRIPT, token)
+        return self.run_script(self.LUA_ACQUIRE_SHA, self.LUA_ACQUIRE_SCRIPT, token, self.timeout_ms)
+
     def locked(self):
         """
         判断是否上锁成功
         """
-        return self.redis.get(self.name) is not None
+        # EXISTS 只返回一个整数，不用把锁的 token 传回客户端
+        return self.redis.exists(self.name) == 1
 
     def owned(self):
         """
         如果使用的是 thread_local 存储 token，那么判断这个 token 是否上锁成功。上面的 locked 判断的只是实例的 token 是否上锁成功
         """
-        stored_token = self.redis.get(self.name)
-        if stored_token and not isinstance(stored_token, bytes):
-            encoder = self.redis.connection_pool.get_encoder()
-            stored_token = encoder.encode(stored_token)
-        return self.local.token is not None and stored_token == self.local.token
+        token = self.local.token
+        if token is None:
+            return False
+        # 在 Redis 端比较 token，避免把锁的值取回客户端再编码比较
+        return self.run_script(self.LUA_OWNED_SHA, self.LUA_OWNED_SCRIPT, token) == 1
 
     def release(self):
         """
@@ -194,37 +565,42 @@ class Lock:
         self.do_release(expected_token)
 
     def do_release(self, expected_token):
-        if not bool(self.lua_release(keys=[self.name], args=[expected_token], client=self.redis)):
-            raise LockNotOwnedError("Cannot release a lock that's no longer owned")
+        # LUA 脚本返回的是整数 0/1，直接比较，不用再 bool() 转换
+        if self.run_script(self.LUA_RELEASE_SHA, self.LUA_RELEASE_SCRIPT, expected_token) != 1:
+            raise LockNotOwnedError(self.NOT_OWNED_RELEASE)
 
-    def extend(self, additional_time, replace_ttl=False):
+    def extend(self, additional_time=None, replace_ttl=False, additional_time_ms=None):
         """
         为已获得的锁增加时间
         additional_time - 可以指定为整数或浮点数，两者都表示要添加的秒数。
         replace_ttl - 如果为False(默认值)，将 'additional_time' 添加到锁现有的 ttl中。如果为 True，将锁的 ttl替换为 'additional_time'。
+        additional_time_ms - 以毫秒为单位的整数，代替 'additional_time' 使用，已经是毫秒值的调用方不用再换算。两者只能指定一个
         """
+        if (additional_time is None) == (additional_time_ms is None):
+            raise TypeError("Exactly one of additional_time and additional_time_ms must be given")
         if self.local.token is None:
             raise LockError("Cannot extend an unlocked lock")
         # 不能对没有设置超时时间的锁设置新的时间
-        if self.timeout is None:
+        if self.timeout_ms is None:
             raise LockError("Cannot extend a lock with no timeout")
-        return self.do_extend(additional_time, replace_ttl)
-
-    def do_extend(self, additional_time, replace_ttl):
-        # 时间转换为毫秒
-        additional_time = int(additional_time * 1000)
-        if not bool(
-            self.lua_extend(
-                keys=[self.name],
-                args=[
-                    self.local.token,
-                    additional_time,
-                    replace_ttl and "1" or "0"
-                ],
-                client=self.redis,
+        return self.do_extend(additional_time, replace_ttl, additional_time_ms)
+
+    def do_extend(self, additional_time, replace_ttl, additional_time_ms=None):
+        if additional_time_ms is None:
+            # 时间转换为毫秒
+            additional_time_ms = int(additional_time * 1000)
+        token = self.local.token
+        # 替换 TTL 和增加 TTL 分别是两个脚本，在 Python 端选择，LUA 脚本里不用再判断参数
+        if replace_ttl:
+            result = self.run_script(
+                self.LUA_EXTEND_REPLACE_SHA, self.LUA_EXTEND_REPLACE_SCRIPT, token, additional_time_ms
             )
-        ):
-            raise LockNotOwnedError("Cannot extend a lock that's" " no longer owned")
+        else:
+            result = self.run_script(
+                self.LUA_EXTEND_ADD_SHA, self.LUA_EXTEND_ADD_SCRIPT, token, additional_time_ms
+            )
+        if result != 1:
+            raise LockNotOwnedError(self.NOT_OWNED_EXTEND)
         return True
 
     def reacquire(self):
@@ -233,12 +609,192 @@ class Lock:
         """
         if self.local.token is None:
             raise LockError("Cannot reacquire an unlocked lock")
-        if self.timeout is None:
+        if self.timeout_ms is None:
             raise LockError("Cannot reacquire a lock with no timeout")
         return self.do_reacquire()
 
     def do_reacquire(self):
-        timeout = int(self.timeout * 1000)
-        if not bool(self.lua_reacquire(keys=[self.name], args=[self.local.token, timeout], client=self.redis)):
-            raise LockNotOwnedError("Cannot reacquire a lock that's no longer owned")
+        if (
+            self.run_script(self.LUA_REACQUIRE_SHA, self.LUA_REACQUIRE_SCRIPT, self.local.token, self.timeout_ms)
+            != 1
+        ):
+            raise LockNotOwnedError(self.NOT_OWNED_REACQUIRE)
+        return True
+
+
+class AsyncLock:
+    """
+    Lock 的 asyncio 版本，需要传入 redis.asyncio.Redis 客户端，LUA 脚本和 SHA1 与 Lock 相同。
+    这只是把 Lock 改写成协程，没有做 pipeline 合并：redis.asyncio 的每条命令各自从连接池取一个连接执行，
+    多个协程同时 acquire 时每个锁仍然各自一次网络往返，只是等待期间不会阻塞事件循环。
+    等待锁时使用 sleep 或指数退避轮询，不订阅锁释放的通知
+    """
+
+    __slots__ = (
+        "redis",
+        "name",
+        "_timeout",
+        "timeout_ms",
+        "sleep",
+        "blocking",
+        "blocking_timeout",
+        "backoff",
+        "sleep_base",
+        "sleep_cap",
+        "token",
+        "_encoder",
+        "__weakref__",
+    )
+
+    def __init__(
+        self,
+        redis,
+        name,
+        timeout=None,
+        sleep=0.1,
+        blocking=True,
+        blocking_timeout=None,
+        backoff=False,
+        sleep_base=0.001,
+        sleep_cap=1.0,
+    ):
+        """
+        参数和 Lock 相同。协程之间没有线程本地存储，token 直接保存在实例上
+        """
+        self.redis = redis
+        self.name = name
+        self.timeout = timeout
+        self.sleep = sleep
+        self.blocking = blocking
+        self.blocking_timeout = blocking_timeout
+        self.backoff = backoff
+        self.sleep_base = sleep_base
+        self.sleep_cap = sleep_cap
+        self.token = None
+        self._encoder = redis.get_encoder()
+
+    @property
+    def timeout(self):
+        """
+        锁释放时间，单位是秒
+        """
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        self.timeout_ms = int(value * 1000) if value else None
+
+    async def run_script(self, sha, script, *args):
+        """
+        通过 EVALSHA 执行脚本，NOSCRIPT 时退回到 EVAL
+        """
+        try:
+            return await self.redis.evalsha(sha, 1, self.name, *args)
+        except NoScriptError:
+            return await self.redis.eval(script, 1, self.name, *args)
+
+    # 提供 async with 语法
+    async def __aenter__(self):
+        if await self.acquire():
+            return self
+        raise LockError("Unable to acquire lock within the time specified")
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.release()
+
+    async def acquire(self, blocking=None, blocking_timeout=None, token=None):
+        """
+        参数和 Lock.acquire 相同
+        """
+        if token is None:
+            token = os.urandom(16).hex().encode("ascii")
+        else:
+            token = self._encoder.encode(token)
+        if blocking is None:
+            blocking = self.blocking
+        if blocking_timeout is None:
+            blocking_timeout = self.blocking_timeout
+
+        stop_trying_at = None
+        if blocking_timeout is not None:
+            stop_trying_at = mod_time.monotonic() + blocking_timeout
+
+        attempt = 0
+        while True:
+            if await self.do_acquire(token):
+                self.token = token
+                return True
+            if not blocking:
+                return False
+            delay, attempt = _retry_delay(self, attempt, stop_trying_at)
+            if delay is None:
+                return False
+            # 让出事件循环，等待期间其他协程可以继续运行
+            await asyncio.sleep(delay)
+
+    async def do_acquire(self, token):
+        if await self.redis.set(self.name, token, nx=True, px=self.timeout_ms):
+            return True
+        return False
+
+    async def locked(self):
+        return await self.redis.exists(self.name) == 1
+
+    async def owned(self):
+        if self.token is None:
+            return False
+        return await self.run_script(Lock.LUA_OWNED_SHA, Lock.LUA_OWNED_SCRIPT, self.token) == 1
+
+    async def release(self):
+        expected_token = self.token
+        if expected_token is None:
+            raise LockError("Cannot release an unlocked lock")
+        self.token = None
+        await self.do_release(expected_token)
+
+    async def do_release(self, expected_token):
+        if await self.run_script(Lock.LUA_RELEASE_SHA, Lock.LUA_RELEASE_SCRIPT, expected_token) != 1:
+            raise LockNotOwnedError(Lock.NOT_OWNED_RELEASE)
+
+    async def extend(self, additional_time=None, replace_ttl=False, additional_time_ms=None):
+        """
+        参数和 Lock.extend 相同
+        """
+        if (additional_time is None) == (additional_time_ms is None):
+            raise TypeError("Exactly one of additional_time and additional_time_ms must be given")
+        if self.token is None:
+            raise LockError("Cannot extend an unlocked lock")
+        if self.timeout_ms is None:
+            raise LockError("Cannot extend a lock with no timeout")
+        return await self.do_extend(additional_time, replace_ttl, additional_time_ms)
+
+    async def do_extend(self, additional_time, replace_ttl, additional_time_ms=None):
+        if additional_time_ms is None:
+            additional_time_ms = int(additional_time * 1000)
+        if replace_ttl:
+            result = await self.run_script(
+                Lock.LUA_EXTEND_REPLACE_SHA, Lock.LUA_EXTEND_REPLACE_SCRIPT, self.token, additional_time_ms
+            )
+        else:
+            result = await self.run_script(
+                Lock.LUA_EXTEND_ADD_SHA, Lock.LUA_EXTEND_ADD_SCRIPT, self.token, additional_time_ms
+            )
+        if result != 1:
+            raise LockNotOwnedError(Lock.NOT_OWNED_EXTEND)
+        return True
+
+    async def reacquire(self):
+        if self.token is None:
+            raise LockError("Cannot reacquire an unlocked lock")
+        if self.timeout_ms is None:
+            raise LockError("Cannot reacquire a lock with no timeout")
+        return await self.do_reacquire()
+
+    async def do_reacquire(self):
+        if (
+            await self.run_script(Lock.LUA_REACQUIRE_SHA, Lock.LUA_REACQUIRE_SCRIPT, self.token, self.timeout_ms)
+            != 1
+        ):
+            raise LockNotOwnedError(Lock.NOT_OWNED_REACQUIRE)
         return True